@@ -1,13 +1,22 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
-from typing import Dict, List, Optional
-import json
-import requests
-from datetime import datetime
+from fastapi.responses import HTMLResponse, Response
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type, TypeVar, Union, cast
+from types import MappingProxyType
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import re
+from cachetools import TTLCache
+import httpx
+import msgspec
+import redis.asyncio as redis
+from datetime import datetime, timezone
+import time
 import uuid
+import weakref
 from dotenv import load_dotenv
 import os
 load_dotenv()
@@ -17,10 +26,41 @@ GEMINI_API_KEY= os.getenv("GEMINI_API_KEY")
 os.makedirs("static", exist_ok=True)
 os.makedirs("templates", exist_ok=True)
 
+# Upstream connection pool, sized to the number of concurrent Gemini calls
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "50"))
+HTTPX_POOL = int(os.getenv("HTTPX_POOL", "100"))
+
+# Session history lives in Redis when configured so every worker sees it
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one pooled HTTP client and Redis connection across all requests"""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=5, read=60, write=10, pool=5),
+        limits=httpx.Limits(
+            max_connections=HTTPX_POOL,
+            # Over HTTP/2 every Gemini stream shares one connection to the host; idle
+            # keepalive slots only matter if a server negotiates HTTP/1.1 instead
+            max_keepalive_connections=50,
+            keepalive_expiry=60
+        )
+    )
+    app.state.redis = redis.from_url(REDIS_URL) if REDIS_URL else None
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
 app = FastAPI(
     title="Blueprint Generator API",
     description="AI-powered architectural blueprint generation system",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # Mount static files
@@ -49,8 +89,52 @@ BUILDING_TYPES = [
 # Room directions
 ROOM_DIRECTIONS = ["North", "South", "East", "West", "Northeast", "Northwest", "Southeast", "Southwest", "Center"]
 
-# Pydantic models for API
-class BuildingRequirements(BaseModel):
+# Direction lookup indexed by the x and y position bands from _position_band:
+# corners need both axes beyond +/-5, otherwise x beyond +/-2 wins over y
+DIRECTION_GRID = (
+    ("Southwest", "West", "West", "West", "Northwest"),
+    ("West", "West", "West", "West", "West"),
+    ("South", "South", "Center", "North", "North"),
+    ("East", "East", "East", "East", "East"),
+    ("Southeast", "East", "East", "East", "Northeast")
+)
+
+def _position_band(value: float) -> int:
+    """Bucket a coordinate into (<-5, -5..-2, -2..2, 2..5, >5) as 0-4"""
+    return (value >= -5) + (value >= -2) + (value > 2) + (value > 5)
+
+# Default room colors by room type
+ROOM_COLORS = MappingProxyType({
+    "living": "#e3f2fd",
+    "bedroom": "#f3e5f5",
+    "kitchen": "#e8f5e8",
+    "bathroom": "#fff3e0",
+    "office": "#e1f5fe",
+    "dining": "#fce4ec",
+    "storage": "#f5f5f5",
+    "hallway": "#f9f9f9",
+    "lobby": "#e0f2f1",
+    "conference": "#fff8e1",
+    "medical": "#e8eaf6",
+    "lab": "#f1f8e9",
+    "ward": "#fafafa"
+})
+
+# Suggested rooms by building type
+ROOM_SUGGESTIONS = MappingProxyType({
+    "residential_house": ("living_room", "kitchen", "bedrooms", "bathrooms", "dining_room"),
+    "hospital": ("reception", "waiting_area", "examination_rooms", "wards", "operating_theater", "pharmacy", "laboratory"),
+    "office_building": ("reception", "offices", "conference_rooms", "break_room", "storage"),
+    "school": ("classrooms", "library", "cafeteria", "gymnasium", "administration_office"),
+    "restaurant": ("dining_area", "kitchen", "storage", "restrooms", "bar_area"),
+    "hotel": ("lobby", "guest_rooms", "restaurant", "conference_rooms", "fitness_center")
+})
+DEFAULT_ROOM_SUGGESTIONS = ("main_area", "secondary_areas", "utilities")
+
+T = TypeVar("T")
+
+# msgspec structs for API
+class BuildingRequirements(msgspec.Struct):
     building_type: str
     total_area: float
     floors: int
@@ -58,213 +142,347 @@ class BuildingRequirements(BaseModel):
     special_features: List[str]
     budget_level: str = "standard"
 
-class DesignFeedback(BaseModel):
+class DesignFeedback(msgspec.Struct):
     feedback: str
     session_id: str
 
-class OptimizationRequest(BaseModel):
+class OptimizationRequest(msgspec.Struct):
     goals: List[str]
 
-class FloorUpdateRequest(BaseModel):
+class FloorUpdateRequest(msgspec.Struct):
     floor_number: int
     session_id: str
 
-class BlueprintResponse(BaseModel):
+class BlueprintResponse(msgspec.Struct):
     success: bool
-    blueprint: Optional[Dict] = None
     message: str
     version: int
     timestamp: str
+    blueprint: Optional[Dict] = None
     session_id: Optional[str] = None
 
-# Global storage for demo purposes (use database in production)
-design_storage = {}
+# Keys and indexes in a msgspec error path such as "$.floors[0].rooms"
+JSON_PATH_PARTS = re.compile(r'\.([^.\[`]+)|\[(\d+)\]')
+MISSING_FIELD = re.compile(r'Object missing required field `([^`]+)`')
 
-class GeminiBlueprintGenerator:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
-        self.design_history = []
-        self.current_floor = 1
-        
-    def generate_initial_blueprint(self, requirements: BuildingRequirements) -> Dict:
-        """Generate initial blueprint based on requirements"""
-        prompt = self._generate_initial_prompt(requirements)
-        response = self._call_gemini_api(prompt)
-        blueprint = self._parse_blueprint_response(response)
-        
-        # Ensure proper floor structure
-        blueprint = self._validate_and_fix_blueprint(blueprint, requirements)
-        
-        # Store in history
-        self.design_history.append({
-            "version": 1,
-            "blueprint": blueprint,
-            "feedback": "Initial generation",
-            "timestamp": datetime.now().isoformat(),
-            "changes_made": ["Initial creation"],
-            "current_floor": 1
-        })
-        
-        return blueprint
+async def decode_body(request: Request, model: Type[T]) -> T:
+    """Decode and validate a JSON request body straight into a msgspec struct"""
+    try:
+        return msgspec.json.decode(await request.body(), type=model)
+    except msgspec.DecodeError as e:
+        # Report it in the shape FastAPI uses for its own validation errors
+        msg, _, path = str(e).partition(" - at `$")
+        loc: List[Union[str, int]] = ["body"]
+        loc.extend(key or int(index) for key, index in JSON_PATH_PARTS.findall(path))
+        missing = MISSING_FIELD.match(msg)
+        if missing:
+            error_type, msg = "missing", "Field required"
+            loc.append(missing.group(1))
+        elif isinstance(e, msgspec.ValidationError):
+            error_type = "value_error"
+        else:
+            error_type = "json_invalid"
+        raise RequestValidationError([{"type": error_type, "loc": loc, "msg": msg, "input": None}])
+
+def blueprint_response(**fields) -> Response:
+    """Encode a BlueprintResponse with msgspec"""
+    return Response(msgspec.json.encode(BlueprintResponse(**fields)), media_type="application/json")
+
+def json_schema(model: type) -> Dict:
+    """OpenAPI schema for a flat msgspec struct"""
+    _, components = msgspec.json.schema_components([model], ref_template="#/components/schemas/{name}")
+    return components[model.__name__]
+
+def request_body_docs(model: type) -> Dict:
+    """openapi_extra documenting a request body that the handler decodes itself"""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": json_schema(model)}}}}
+
+# Same shape as FastAPI's HTTPValidationError, which decode_body errors are raised as
+VALIDATION_ERROR_SCHEMA = {
+    "title": "HTTPValidationError",
+    "type": "object",
+    "properties": {
+        "detail": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "loc": {"type": "array", "items": {"anyOf": [{"type": "string"}, {"type": "integer"}]}},
+                    "msg": {"type": "string"},
+                    "type": {"type": "string"}
+                },
+                "required": ["loc", "msg", "type"]
+            }
+        }
+    }
+}
+
+BLUEPRINT_RESPONSE_DOCS: Dict[Union[int, str], Dict[str, Any]] = {
+    200: {"content": {"application/json": {"schema": json_schema(BlueprintResponse)}}},
+    422: {"description": "Validation Error", "content": {"application/json": {"schema": VALIDATION_ERROR_SCHEMA}}}
+}
+
+# msgspec structs for the parts of a Gemini blueprint the server reads or fills in.
+# They validate that shape; the raw dict keeps every other key the model returned.
+class Position(msgspec.Struct):
+    x: float = 0.0
+    y: float = 0.0
+
+class Room(msgspec.Struct):
+    type: Optional[str] = "general"
+    # Only read for rooms without a direction, so odd shapes are tolerated rather than rejected
+    position: Union[Position, List[Any], None] = None
+
+class FloorPlan(msgspec.Struct):
+    rooms: List[Room] = []
+
+class Blueprint(msgspec.Struct):
+    # Required, so a stray object in the model's prose isn't taken for a blueprint
+    floor_plans: List[FloorPlan]
+    metadata: Dict = {}
+
+# Characters that matter when brace-matching JSON text
+JSON_STRUCTURE_CHARS = re.compile(r'[{}"\\]')
+
+class JsonObjectScanner:
+    """Find each top-level JSON object in turn in text that arrives in pieces"""
+    def __init__(self):
+        self.start = -1
+        self.end = -1
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
     
-    def iterate_design(self, user_feedback: str) -> Dict:
-        """Iterate on existing design based on user feedback"""
-        if not self.design_history:
-            raise ValueError("No existing design to iterate on")
+    def scan(self, text: str) -> bool:
+        """Scan text (which only ever grows) and return True once the next object closes"""
+        pos = self._pos
+        while True:
+            match = JSON_STRUCTURE_CHARS.search(text, pos)
+            if match is None:
+                self._pos = len(text)
+                return False
             
-        current_design = self.design_history[-1]["blueprint"]
-        prompt = self._generate_iteration_prompt(current_design, user_feedback)
-        response = self._call_gemini_api(prompt)
-        updated_blueprint = self._parse_blueprint_response(response)
-        
-        # Validate and maintain floor structure
-        updated_blueprint = self._validate_and_fix_blueprint(updated_blueprint, None)
-        
-        # Store iteration
-        self.design_history.append({
-            "version": len(self.design_history) + 1,
-            "blueprint": updated_blueprint,
-            "feedback": user_feedback,
-            "timestamp": datetime.now().isoformat(),
-            "changes_made": ["User feedback integration"],
-            "current_floor": self.current_floor
-        })
-        
-        return updated_blueprint
+            index = match.start()
+            char = text[index]
+            pos = index + 1
+            if self._in_string:
+                if char == "\\":
+                    if pos == len(text):
+                        # Escaped character hasn't arrived yet
+                        self._pos = index
+                        return False
+                    pos += 1
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = self._depth > 0
+            elif char == "{":
+                if self._depth == 0:
+                    self.start = index
+                self._depth += 1
+            elif char == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = self._pos = pos
+                    return True
+
+def format_timestamp(timestamp_ns: int) -> str:
+    """Format a time.time_ns() value as an ISO 8601 UTC timestamp"""
+    return datetime.fromtimestamp(timestamp_ns / 1e9, tz=timezone.utc).isoformat()
+
+# In-process fallback storage when REDIS_URL is not set (single worker only),
+# shaped like the Redis keys: {"history": [entries], "blueprint_json": str, "current_floor": n}
+design_storage: Dict[str, Dict] = {}
+
+def _session_key(session_id: str, part: str) -> str:
+    """Redis key for one part of a session"""
+    return f"session:{session_id}:{part}"
+
+async def load_history(redis_client: Optional[redis.Redis], session_id: str) -> Optional[List[Dict]]:
+    """Load a session's full design history, or None if the session is unknown"""
+    if redis_client is None:
+        session = design_storage.get(session_id)
+        return None if session is None else session["history"]
     
-    def update_floor_view(self, floor_number: int) -> Dict:
-        """Update current floor view without changing the blueprint"""
-        if not self.design_history:
-            raise ValueError("No existing design to view")
-            
-        self.current_floor = floor_number
-        current_blueprint = self.design_history[-1]["blueprint"]
-        
-        # Update current floor in history
-        self.design_history[-1]["current_floor"] = floor_number
-        
-        return current_blueprint
+    entries = cast(List[bytes], await redis_client.lrange(_session_key(session_id, "history"), 0, -1))
+    if not entries:
+        return None
+    return [msgspec.msgpack.decode(entry, type=dict) for entry in entries]
+
+async def load_latest(redis_client: Optional[redis.Redis], session_id: str) -> Optional[Tuple[Dict, int]]:
+    """Load a session's latest history entry and its version, or None if the session is unknown"""
+    if redis_client is None:
+        session = design_storage.get(session_id)
+        if session is None:
+            return None
+        return session["history"][-1], len(session["history"])
     
-    def optimize_design(self, optimization_goals: List[str]) -> Dict:
-        """Optimize design for specific goals"""
-        if not self.design_history:
-            raise ValueError("No existing design to optimize")
-            
-        current_design = self.design_history[-1]["blueprint"]
-        prompt = self._generate_optimization_prompt(current_design, optimization_goals)
-        response = self._call_gemini_api(prompt)
-        optimized_blueprint = self._parse_blueprint_response(response)
-        
-        # Validate and maintain floor structure
-        optimized_blueprint = self._validate_and_fix_blueprint(optimized_blueprint, None)
-        
-        # Store optimization
-        self.design_history.append({
-            "version": len(self.design_history) + 1,
-            "blueprint": optimized_blueprint,
-            "feedback": f"Optimization for: {', '.join(optimization_goals)}",
-            "timestamp": datetime.now().isoformat(),
-            "changes_made": ["Design optimization"],
-            "current_floor": self.current_floor
-        })
-        
-        return optimized_blueprint
+    # MULTI/EXEC so another worker's RPUSH can't land between the two reads
+    history_key = _session_key(session_id, "history")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lindex(history_key, -1)
+        pipe.llen(history_key)
+        entry, version = await pipe.execute()
+    if entry is None:
+        return None
+    return msgspec.msgpack.decode(entry, type=dict), version
+
+async def load_blueprint_json(redis_client: Optional[redis.Redis], session_id: str) -> Optional[str]:
+    """Load the serialized latest blueprint that prompts are built from, or None if the session is unknown"""
+    if redis_client is None:
+        session = design_storage.get(session_id)
+        return None if session is None else session["blueprint_json"]
     
-    def _validate_and_fix_blueprint(self, blueprint: Dict, requirements: Optional[BuildingRequirements]) -> Dict:
-        """Validate and fix blueprint structure"""
-        # Ensure all rooms have directions
-        for floor_plan in blueprint.get("floor_plans", []):
-            for room in floor_plan.get("rooms", []):
-                if "direction" not in room:
-                    # Assign direction based on position
-                    room["direction"] = self._calculate_room_direction(room)
-                
-                # Ensure room has all required fields
-                if "features" not in room:
-                    room["features"] = []
-                if "color" not in room:
-                    room["color"] = self._get_default_room_color(room.get("type", "general"))
-        
-        return blueprint
+    # The client doesn't set decode_responses, so replies are always bytes
+    blueprint_json = cast(Optional[bytes], await redis_client.get(_session_key(session_id, "blueprint_json")))
+    return None if blueprint_json is None else blueprint_json.decode()
+
+async def append_history(redis_client: Optional[redis.Redis], session_id: str, entry: Dict) -> int:
+    """Append an entry to a session's history and refresh its expiry; returns the entry's version"""
+    # Only the latest blueprint is ever sent back to Gemini, so its JSON is kept once
+    # per session instead of alongside every history entry
+    blueprint_json = _serialize_blueprint(entry["blueprint"])
+    if redis_client is None:
+        session = design_storage.setdefault(session_id, {"history": [], "current_floor": 1})
+        session["history"].append(entry)
+        session["blueprint_json"] = blueprint_json
+        return len(session["history"])
     
-    def _calculate_room_direction(self, room: Dict) -> str:
-        """Calculate room direction based on position"""
-        pos = room.get("position", {"x": 0, "y": 0})
-        x, y = pos.get("x", 0), pos.get("y", 0)
-        
-        # Simple direction calculation based on position
-        if x < -5 and y > 5:
-            return "Northwest"
-        elif x > 5 and y > 5:
-            return "Northeast"
-        elif x < -5 and y < -5:
-            return "Southwest"
-        elif x > 5 and y < -5:
-            return "Southeast"
-        elif x < -2:
-            return "West"
-        elif x > 2:
-            return "East"
-        elif y > 2:
-            return "North"
-        elif y < -2:
-            return "South"
-        else:
-            return "Center"
+    # RPUSH appends atomically, so concurrent workers never overwrite each other's entries
+    history_key = _session_key(session_id, "history")
+    floor_key = _session_key(session_id, "floor")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(history_key, msgspec.msgpack.encode(entry))
+        pipe.expire(history_key, SESSION_TTL)
+        pipe.set(_session_key(session_id, "blueprint_json"), blueprint_json, ex=SESSION_TTL)
+        pipe.set(floor_key, 1, ex=SESSION_TTL, nx=True)
+        pipe.expire(floor_key, SESSION_TTL)
+        version, *_ = await pipe.execute()
+    return version
+
+async def load_current_floor(redis_client: Optional[redis.Redis], session_id: str) -> Optional[int]:
+    """Load the floor a session is viewing, or None if the session is unknown"""
+    if redis_client is None:
+        session = design_storage.get(session_id)
+        return None if session is None else session["current_floor"]
     
-    def _get_default_room_color(self, room_type: str) -> str:
-        """Get default color for room type"""
-        color_map = {
-            "living": "#e3f2fd",
-            "bedroom": "#f3e5f5",
-            "kitchen": "#e8f5e8",
-            "bathroom": "#fff3e0",
-            "office": "#e1f5fe",
-            "dining": "#fce4ec",
-            "storage": "#f5f5f5",
-            "hallway": "#f9f9f9",
-            "lobby": "#e0f2f1",
-            "conference": "#fff8e1",
-            "medical": "#e8eaf6",
-            "lab": "#f1f8e9",
-            "ward": "#fafafa"
-        }
-        return color_map.get(room_type, "#f5f5f5")
+    floor = await redis_client.get(_session_key(session_id, "floor"))
+    return None if floor is None else int(floor)
+
+async def save_current_floor(redis_client: Optional[redis.Redis], session_id: str, floor_number: int) -> None:
+    """Record the floor a session is viewing and refresh the session's expiry"""
+    if redis_client is None:
+        design_storage[session_id]["current_floor"] = floor_number
+        return
     
-    def _call_gemini_api(self, prompt: str) -> str:
-        """Make API call to Gemini"""
-        url = f"{self.base_url}?key={self.api_key}"
-        
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.1,
-                "topK": 40,
-                "topP": 0.95,
-                "maxOutputTokens": 8192,
-                "responseMimeType": "text/plain"
-            }
+    history_key = _session_key(session_id, "history")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(_session_key(session_id, "floor"), floor_number, ex=SESSION_TTL)
+        pipe.expire(history_key, SESSION_TTL)
+        pipe.expire(_session_key(session_id, "blueprint_json"), SESSION_TTL)
+        await pipe.execute()
+
+# Per-session locks so concurrent requests on one session append in order
+session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    """Get (or create) the lock guarding a session's design history"""
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        session_locks[session_id] = lock
+    return lock
+
+# Static prompt text, built once and joined around the per-request values
+INITIAL_PROMPT_SCHEMA = """      "rooms": [
+        {
+          "name": "Room Name",
+          "type": "room_type",
+          "dimensions": {
+            "width": 6.0,
+            "length": 8.0,
+            "area": 48.0
+          },
+          "position": {
+            "x": 0,
+            "y": 0
+          },
+          "direction": "North|South|East|West|Northeast|Northwest|Southeast|Southwest|Center",
+          "features": ["feature1", "feature2"],
+          "color": "#hexcolor"
         }
-        
-        try:
-            response = requests.post(url, headers={"Content-Type": "application/json"}, json=payload)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'candidates' in response_data and len(response_data['candidates']) > 0:
-                    return response_data['candidates'][0]['content']['parts'][0]['text']
-                else:
-                    raise Exception("No response generated by Gemini")
-            else:
-                raise Exception(f"API call failed: {response.status_code} - {response.text}")
-        except Exception as e:
-            # Fallback response for demo purposes
-            return self._get_fallback_response()
-    
-    def _get_fallback_response(self) -> str:
-        """Fallback response when API fails"""
-        return '''
+      ]
+    }
+  ],
+  "design_constraints": {
+    "building_codes": ["relevant_building_codes"],
+    "min_room_dimensions": {
+      "bedroom": {"min_area": 12, "min_width": 3},
+      "bathroom": {"min_area": 6, "min_width": 2}
+    }
+  },
+  "metadata": {
+    "created_date": "filled_in_by_server",
+    "version": "1.0",
+    "generator": "Gemini Blueprint System"
+  }
+}
+
+IMPORTANT:
+"""
+
+INITIAL_PROMPT_FOOTER = """5. Position rooms logically and ensure they don't overlap
+
+Return only the JSON, no additional text.
+"""
+
+ITERATION_PROMPT_HEADER = """
+Modify this architectural blueprint based on user feedback. Maintain the multi-floor structure and room directions.
+
+Current Blueprint:
+"""
+
+ITERATION_PROMPT_FEEDBACK = """
+
+User Feedback:
+"""
+
+ITERATION_PROMPT_FOOTER = """
+
+IMPORTANT:
+1. Keep the same number of floors as in the original blueprint
+2. Each room MUST have a "direction" field
+3. Update room positions, dimensions, and colors as needed based on feedback
+4. Maintain logical room placement and avoid overlaps
+5. Keep the same JSON structure
+
+Return only the updated JSON blueprint, no additional text.
+"""
+
+OPTIMIZATION_PROMPT_HEADER = """
+Optimize this architectural blueprint for these goals while maintaining structure and room directions.
+
+Current Blueprint:
+"""
+
+OPTIMIZATION_PROMPT_GOALS = """
+
+Optimization Goals:
+"""
+
+OPTIMIZATION_PROMPT_FOOTER = """
+
+IMPORTANT:
+1. Keep the same number of floors
+2. Each room MUST have a "direction" field
+3. Optimize room sizes, positions, and features based on goals
+4. Maintain the same JSON structure
+
+Return only the optimized JSON blueprint, no additional text.
+"""
+
+# Demo blueprint served when Gemini is unavailable; validated once at import
+FALLBACK_RESPONSE = '''
 {
   "building_info": {
     "type": "residential_house",
@@ -350,32 +568,226 @@ class GeminiBlueprintGenerator:
   }
 }
 '''
+FALLBACK_BLUEPRINT_JSON = msgspec.json.encode(msgspec.json.decode(FALLBACK_RESPONSE))
+msgspec.convert(msgspec.json.decode(FALLBACK_BLUEPRINT_JSON), type=Blueprint)
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:streamGenerateContent"
+
+# Cap in-flight Gemini requests to stay within the account's rate limit
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Validated blueprint JSON keyed by prompt digest, plus calls still in flight
+gemini_response_cache: "TTLCache[bytes, str]" = TTLCache(maxsize=1024, ttl=3600)
+gemini_inflight: Dict[bytes, asyncio.Task] = {}
+
+async def generate_initial_blueprint(client: httpx.AsyncClient, api_key: str, requirements: BuildingRequirements) -> Dict:
+    """Generate initial blueprint based on requirements, returning its history entry"""
+    prompt = _generate_initial_prompt(requirements)
+    response = await _call_gemini_api(client, api_key, prompt)
+    blueprint, layout = _load_blueprint(response)
+    
+    # Ensure proper floor structure
+    blueprint = _validate_and_fix_blueprint(blueprint, layout, requirements)
+    
+    # The prompt leaves created_date as a placeholder so it stays cacheable
+    timestamp_ns = time.time_ns()
+    blueprint.setdefault("metadata", {})["created_date"] = format_timestamp(timestamp_ns)
     
-    def _parse_blueprint_response(self, response: str) -> Dict:
-        """Parse and validate blueprint JSON response"""
-        try:
-            if "```json" in response:
-                start = response.find("```json") + 7
-                end = response.find("```", start)
-                json_str = response[start:end].strip()
-            elif "```" in response:
-                start = response.find("```") + 3
-                end = response.find("```", start)
-                json_str = response[start:end].strip()
-            else:
-                json_str = response.strip()
+    return {
+        "blueprint": blueprint,
+        "feedback": "Initial generation",
+        "timestamp_ns": timestamp_ns,
+        "changes_made": ["Initial creation"]
+    }
+
+async def iterate_design(client: httpx.AsyncClient, api_key: str, blueprint_json: str, user_feedback: str) -> Dict:
+    """Iterate on the latest design based on user feedback, returning the new history entry"""
+    prompt = _generate_iteration_prompt(blueprint_json, user_feedback)
+    response = await _call_gemini_api(client, api_key, prompt)
+    updated_blueprint, layout = _load_blueprint(response)
+    
+    # Validate and maintain floor structure
+    updated_blueprint = _validate_and_fix_blueprint(updated_blueprint, layout, None)
+    
+    return {
+        "blueprint": updated_blueprint,
+        "feedback": user_feedback,
+        "timestamp_ns": time.time_ns(),
+        "changes_made": ["User feedback integration"]
+    }
+
+async def optimize_design(client: httpx.AsyncClient, api_key: str, blueprint_json: str, optimization_goals: List[str]) -> Dict:
+    """Optimize the latest design for specific goals, returning the new history entry"""
+    prompt = _generate_optimization_prompt(blueprint_json, optimization_goals)
+    response = await _call_gemini_api(client, api_key, prompt)
+    optimized_blueprint, layout = _load_blueprint(response)
+    
+    # Validate and maintain floor structure
+    optimized_blueprint = _validate_and_fix_blueprint(optimized_blueprint, layout, None)
+    
+    return {
+        "blueprint": optimized_blueprint,
+        "feedback": f"Optimization for: {', '.join(optimization_goals)}",
+        "timestamp_ns": time.time_ns(),
+        "changes_made": ["Design optimization"]
+    }
+
+def _validate_and_fix_blueprint(blueprint: Dict, layout: Blueprint, requirements: Optional[BuildingRequirements]) -> Dict:
+    """Validate and fix blueprint structure"""
+    # Walk the raw dict alongside its validated view
+    for floor_plan, floor_layout in zip(blueprint.get("floor_plans", []), layout.floor_plans):
+        for room, room_layout in zip(floor_plan.get("rooms", []), floor_layout.rooms):
+            if "direction" not in room:
+                # Assign direction based on position
+                room["direction"] = _calculate_room_direction(room_layout)
             
-            return json.loads(json_str)
+            # Ensure room has all required fields
+            if "features" not in room:
+                room["features"] = []
+            if "color" not in room:
+                room["color"] = _get_default_room_color(room_layout.type or "general")
+    
+    return blueprint
+
+def _serialize_blueprint(blueprint: Dict) -> str:
+    """Serialize a blueprint once so later prompts can reuse it"""
+    # Compact output: indentation roughly doubles the tokens sent back to Gemini
+    return msgspec.json.encode(blueprint).decode()
+
+def _calculate_room_direction(room: Room) -> str:
+    """Calculate room direction based on position"""
+    position = room.position if isinstance(room.position, Position) else Position()
+    return DIRECTION_GRID[_position_band(position.x)][_position_band(position.y)]
+
+def _get_default_room_color(room_type: str) -> str:
+    """Get default color for room type"""
+    return ROOM_COLORS.get(room_type, "#f5f5f5")
+
+async def _call_gemini_api(client: httpx.AsyncClient, api_key: str, prompt: str) -> Optional[str]:
+    """Get blueprint JSON from Gemini, sharing one upstream call per distinct prompt; None if it failed"""
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    cached = gemini_response_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    # No await between lookup and insert, so identical concurrent prompts join one task
+    task = gemini_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_request_gemini(client, api_key, prompt))
+        gemini_inflight[key] = task
+        task.add_done_callback(lambda done: _finish_request(key, done))
+    
+    try:
+        # Shield so one caller going away doesn't cancel the call for the others
+        return await asyncio.shield(task)
+    except Exception as e:
+        # Callers fall back to the demo blueprint
+        return None
+
+def _finish_request(key: bytes, task: asyncio.Task) -> None:
+    """Drop a finished call from the in-flight table and cache it if it produced a blueprint"""
+    del gemini_inflight[key]
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        gemini_response_cache[key] = task.result()
+
+async def _request_gemini(client: httpx.AsyncClient, api_key: str, prompt: str) -> Optional[str]:
+    """Send a prompt to Gemini and return the blueprint JSON in its reply, or None if there is none"""
+    url = f"{GEMINI_URL}?alt=sse&key={api_key}"
+    
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {
+            "temperature": 0.1,
+            "topK": 40,
+            "topP": 0.95,
+            "maxOutputTokens": 8192,
+            "responseMimeType": "text/plain"
+        }
+    }
+    
+    # Stream the reply and stop reading as soon as an object that decodes as a blueprint closes
+    scanner = JsonObjectScanner()
+    text = ""
+    received = False
+    async with gemini_semaphore:
+        async with client.stream("POST", url, json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"API call failed: {response.status_code} - {response.text}")
             
-        except json.JSONDecodeError as e:
-            # Return fallback blueprint
-            return json.loads(self._get_fallback_response())
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                chunk = msgspec.json.decode(line[5:])
+                for candidate in chunk.get("candidates", [])[:1]:
+                    received = True
+                    for part in candidate.get("content", {}).get("parts", []):
+                        text += part.get("text", "")
+                while scanner.scan(text):
+                    json_str = text[scanner.start:scanner.end]
+                    if _is_blueprint_json(json_str):
+                        return json_str
     
-    def _generate_initial_prompt(self, requirements: BuildingRequirements) -> str:
-        """Generate initial blueprint creation prompt"""
-        room_suggestions = self._get_room_suggestions(requirements.building_type)
-        
-        return f"""
+    if not received:
+        raise Exception("No response generated by Gemini")
+    return _extract_blueprint_json(text)
+
+def _decode_blueprint(json_str: Union[str, bytes]) -> Tuple[Dict, Blueprint]:
+    """Decode blueprint JSON into its raw dict plus a validated view of the fields we use"""
+    blueprint = msgspec.json.decode(json_str)
+    # Lax mode coerces numeric strings such as {"x": "3"} the way the frontend already reads them
+    return blueprint, msgspec.convert(blueprint, type=Blueprint, strict=False)
+
+def _is_blueprint_json(json_str: str) -> bool:
+    """Check that JSON decodes as a blueprint, in one typed pass that builds no dict"""
+    try:
+        msgspec.json.decode(json_str, type=Blueprint, strict=False)
+    except msgspec.DecodeError:
+        return False
+    return True
+
+def _get_fallback_blueprint() -> Tuple[Dict, Blueprint]:
+    """Fresh copy of the fallback blueprint, decoded from its pre-validated bytes"""
+    return _decode_blueprint(FALLBACK_BLUEPRINT_JSON)
+
+def _blueprint_json_candidates(response: str) -> Iterator[str]:
+    """Places the blueprint JSON may sit in a reply, most likely first"""
+    # One brace-matching pass; fenced blocks are only searched if no object decodes
+    scanner = JsonObjectScanner()
+    while scanner.scan(response):
+        yield response[scanner.start:scanner.end]
+    
+    if "```json" in response:
+        start = response.find("```json") + 7
+        end = response.find("```", start)
+        yield response[start:end].strip()
+    elif "```" in response:
+        start = response.find("```") + 3
+        end = response.find("```", start)
+        yield response[start:end].strip()
+    
+    yield response.strip()
+
+def _extract_blueprint_json(response: str) -> Optional[str]:
+    """Find the blueprint JSON in a reply, or None if no candidate decodes as a blueprint"""
+    for json_str in _blueprint_json_candidates(response):
+        if _is_blueprint_json(json_str):
+            return json_str
+    
+    return None
+
+def _load_blueprint(response: Optional[str]) -> Tuple[Dict, Blueprint]:
+    """Decode a validated Gemini reply, or a fresh fallback blueprint if there was none"""
+    if response is None:
+        return _get_fallback_blueprint()
+    return _decode_blueprint(response)
+
+def _generate_initial_prompt(requirements: BuildingRequirements) -> str:
+    """Generate initial blueprint creation prompt"""
+    room_suggestions = _get_room_suggestions(requirements.building_type)
+    
+    return "".join((
+        f"""
 You are an expert architect. Create a detailed architectural blueprint in JSON format for a {requirements.building_type} building.
 
 Requirements:
@@ -402,105 +814,34 @@ Return a JSON blueprint with this exact structure and include ALL {requirements.
     {{
       "floor_number": 1,
       "area": {requirements.total_area / requirements.floors},
-      "rooms": [
-        {{
-          "name": "Room Name",
-          "type": "room_type",
-          "dimensions": {{
-            "width": 6.0,
-            "length": 8.0,
-            "area": 48.0
-          }},
-          "position": {{
-            "x": 0,
-            "y": 0
-          }},
-          "direction": "North|South|East|West|Northeast|Northwest|Southeast|Southwest|Center",
-          "features": ["feature1", "feature2"],
-          "color": "#hexcolor"
-        }}
-      ]
-    }}
-  ],
-  "design_constraints": {{
-    "building_codes": ["relevant_building_codes"],
-    "min_room_dimensions": {{
-      "bedroom": {{"min_area": 12, "min_width": 3}},
-      "bathroom": {{"min_area": 6, "min_width": 2}}
-    }}
-  }},
-  "metadata": {{
-    "created_date": "{datetime.now().isoformat()}",
-    "version": "1.0",
-    "generator": "Gemini Blueprint System"
-  }}
-}}
-
-IMPORTANT:
-1. Include exactly {requirements.floors} floor plans in the floor_plans array
+""",
+        INITIAL_PROMPT_SCHEMA,
+        f"""1. Include exactly {requirements.floors} floor plans in the floor_plans array
 2. Each room MUST have a "direction" field with one of: North, South, East, West, Northeast, Northwest, Southeast, Southwest, Center
 3. Distribute the total area ({requirements.total_area} sq m) across all floors
 4. Use appropriate room types and colors for {requirements.building_type}
-5. Position rooms logically and ensure they don't overlap
-
-Return only the JSON, no additional text.
-"""
-    
-    def _get_room_suggestions(self, building_type: str) -> List[str]:
-        """Get suggested rooms based on building type"""
-        suggestions = {
-            "residential_house": ["living_room", "kitchen", "bedrooms", "bathrooms", "dining_room"],
-            "hospital": ["reception", "waiting_area", "examination_rooms", "wards", "operating_theater", "pharmacy", "laboratory"],
-            "office_building": ["reception", "offices", "conference_rooms", "break_room", "storage"],
-            "school": ["classrooms", "library", "cafeteria", "gymnasium", "administration_office"],
-            "restaurant": ["dining_area", "kitchen", "storage", "restrooms", "bar_area"],
-            "hotel": ["lobby", "guest_rooms", "restaurant", "conference_rooms", "fitness_center"]
-        }
-        return suggestions.get(building_type, ["main_area", "secondary_areas", "utilities"])
-    
-    def _generate_iteration_prompt(self, current_blueprint: Dict, user_feedback: str) -> str:
-        """Generate iteration prompt"""
-        return f"""
-Modify this architectural blueprint based on user feedback. Maintain the multi-floor structure and room directions.
-
-Current Blueprint:
-{json.dumps(current_blueprint, indent=2)}
-
-User Feedback:
-{user_feedback}
-
-IMPORTANT:
-1. Keep the same number of floors as in the original blueprint
-2. Each room MUST have a "direction" field
-3. Update room positions, dimensions, and colors as needed based on feedback
-4. Maintain logical room placement and avoid overlaps
-5. Keep the same JSON structure
-
-Return only the updated JSON blueprint, no additional text.
-"""
-    
-    def _generate_optimization_prompt(self, current_blueprint: Dict, optimization_goals: List[str]) -> str:
-        """Generate optimization prompt"""
-        return f"""
-Optimize this architectural blueprint for these goals while maintaining structure and room directions.
-
-Current Blueprint:
-{json.dumps(current_blueprint, indent=2)}
-
-Optimization Goals:
-{chr(10).join([f"- {goal}" for goal in optimization_goals])}
-
-IMPORTANT:
-1. Keep the same number of floors
-2. Each room MUST have a "direction" field
-3. Optimize room sizes, positions, and features based on goals
-4. Maintain the same JSON structure
-
-Return only the optimized JSON blueprint, no additional text.
-"""
-
-# Initialize generator
-generator = GeminiBlueprintGenerator(GEMINI_API_KEY)
+""",
+        INITIAL_PROMPT_FOOTER
+    ))
+
+def _get_room_suggestions(building_type: str) -> Tuple[str, ...]:
+    """Get suggested rooms based on building type"""
+    return ROOM_SUGGESTIONS.get(building_type, DEFAULT_ROOM_SUGGESTIONS)
+
+def _generate_iteration_prompt(blueprint_json: str, user_feedback: str) -> str:
+    """Generate iteration prompt"""
+    return "".join((ITERATION_PROMPT_HEADER, blueprint_json, ITERATION_PROMPT_FEEDBACK, user_feedback, ITERATION_PROMPT_FOOTER))
+
+def _generate_optimization_prompt(blueprint_json: str, optimization_goals: List[str]) -> str:
+    """Generate optimization prompt"""
+    return "".join((
+        OPTIMIZATION_PROMPT_HEADER,
+        blueprint_json,
+        OPTIMIZATION_PROMPT_GOALS,
+        "- ",
+        "\n- ".join(optimization_goals),
+        OPTIMIZATION_PROMPT_FOOTER
+    ))
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
@@ -512,116 +853,134 @@ async def get_building_types():
     """Get available building types"""
     return {"building_types": BUILDING_TYPES}
 
-@app.post("/api/generate", response_model=BlueprintResponse)
-async def generate_blueprint(requirements: BuildingRequirements):
+@app.post("/api/generate", response_model=None, responses=BLUEPRINT_RESPONSE_DOCS, openapi_extra=request_body_docs(BuildingRequirements))
+async def generate_blueprint(request: Request) -> Response:
     """Generate initial blueprint"""
+    requirements = await decode_body(request, BuildingRequirements)
     try:
         if requirements.building_type not in BUILDING_TYPES:
             raise HTTPException(status_code=400, detail="Invalid building type")
             
-        blueprint = generator.generate_initial_blueprint(requirements)
+        entry = await generate_initial_blueprint(request.app.state.http, GEMINI_API_KEY, requirements)
         session_id = str(uuid.uuid4())
-        design_storage[session_id] = generator.design_history.copy()
+        version = await append_history(request.app.state.redis, session_id, entry)
         
-        return BlueprintResponse(
+        return blueprint_response(
             success=True,
-            blueprint=blueprint,
+            blueprint=entry["blueprint"],
             message="Blueprint generated successfully",
-            version=1,
-            timestamp=datetime.now().isoformat(),
+            version=version,
+            timestamp=format_timestamp(entry["timestamp_ns"]),
             session_id=session_id
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/iterate", response_model=BlueprintResponse)
-async def iterate_blueprint(feedback: DesignFeedback):
+@app.post("/api/iterate", response_model=None, responses=BLUEPRINT_RESPONSE_DOCS, openapi_extra=request_body_docs(DesignFeedback))
+async def iterate_blueprint(request: Request) -> Response:
     """Iterate on existing blueprint"""
+    feedback = await decode_body(request, DesignFeedback)
     try:
-        if feedback.session_id not in design_storage:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        # Restore generator state
-        generator.design_history = design_storage[feedback.session_id]
-        blueprint = generator.iterate_design(feedback.feedback)
-        design_storage[feedback.session_id] = generator.design_history.copy()
+        async with get_session_lock(feedback.session_id):
+            blueprint_json = await load_blueprint_json(request.app.state.redis, feedback.session_id)
+            if blueprint_json is None:
+                raise HTTPException(status_code=404, detail="Session not found")
+            
+            entry = await iterate_design(request.app.state.http, GEMINI_API_KEY, blueprint_json, feedback.feedback)
+            version = await append_history(request.app.state.redis, feedback.session_id, entry)
         
-        return BlueprintResponse(
+        return blueprint_response(
             success=True,
-            blueprint=blueprint,
+            blueprint=entry["blueprint"],
             message="Blueprint updated successfully based on feedback",
-            version=len(generator.design_history),
-            timestamp=datetime.now().isoformat(),
+            version=version,
+            timestamp=format_timestamp(entry["timestamp_ns"]),
             session_id=feedback.session_id
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/update-floor", response_model=BlueprintResponse)
-async def update_floor_view(floor_request: FloorUpdateRequest):
+@app.post("/api/update-floor", response_model=None, responses=BLUEPRINT_RESPONSE_DOCS, openapi_extra=request_body_docs(FloorUpdateRequest))
+async def update_floor_view(request: Request) -> Response:
     """Update floor view"""
+    floor_request = await decode_body(request, FloorUpdateRequest)
     try:
-        if floor_request.session_id not in design_storage:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        # Restore generator state
-        generator.design_history = design_storage[floor_request.session_id]
-        blueprint = generator.update_floor_view(floor_request.floor_number)
-        design_storage[floor_request.session_id] = generator.design_history.copy()
+        async with get_session_lock(floor_request.session_id):
+            latest = await load_latest(request.app.state.redis, floor_request.session_id)
+            if latest is None:
+                raise HTTPException(status_code=404, detail="Session not found")
+            
+            # Viewing a floor doesn't change the blueprint, so only the floor is stored
+            await save_current_floor(request.app.state.redis, floor_request.session_id, floor_request.floor_number)
+            entry, version = latest
         
-        return BlueprintResponse(
+        return blueprint_response(
             success=True,
-            blueprint=blueprint,
+            blueprint=entry["blueprint"],
             message=f"Floor {floor_request.floor_number} view updated",
-            version=len(generator.design_history),
-            timestamp=datetime.now().isoformat(),
+            version=version,
+            timestamp=format_timestamp(time.time_ns()),
             session_id=floor_request.session_id
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/optimize", response_model=BlueprintResponse)
-async def optimize_blueprint(session_id: str, optimization: OptimizationRequest):
+@app.post("/api/optimize", response_model=None, responses=BLUEPRINT_RESPONSE_DOCS, openapi_extra=request_body_docs(OptimizationRequest))
+async def optimize_blueprint(session_id: str, request: Request) -> Response:
     """Optimize blueprint"""
+    optimization = await decode_body(request, OptimizationRequest)
     try:
-        if session_id not in design_storage:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        # Restore generator state
-        generator.design_history = design_storage[session_id]
-        blueprint = generator.optimize_design(optimization.goals)
-        design_storage[session_id] = generator.design_history.copy()
+        async with get_session_lock(session_id):
+            blueprint_json = await load_blueprint_json(request.app.state.redis, session_id)
+            if blueprint_json is None:
+                raise HTTPException(status_code=404, detail="Session not found")
+            
+            entry = await optimize_design(request.app.state.http, GEMINI_API_KEY, blueprint_json, optimization.goals)
+            version = await append_history(request.app.state.redis, session_id, entry)
         
-        return BlueprintResponse(
+        return blueprint_response(
             success=True,
-            blueprint=blueprint,
+            blueprint=entry["blueprint"],
             message="Blueprint optimized successfully",
-            version=len(generator.design_history),
-            timestamp=datetime.now().isoformat(),
+            version=version,
+            timestamp=format_timestamp(entry["timestamp_ns"]),
             session_id=session_id
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/history/{session_id}")
-async def get_design_history(session_id: str):
+async def get_design_history(session_id: str, request: Request):
     """Get design iteration history"""
-    if session_id not in design_storage:
+    history = await load_history(request.app.state.redis, session_id)
+    if history is None:
         raise HTTPException(status_code=404, detail="Session not found")
+    current_floor = await load_current_floor(request.app.state.redis, session_id) or 1
+    
+    # Versions are list positions, timestamps are stored as integers and the floor is
+    # stored once per session, so all three are filled in here
+    history = [
+        {
+            "version": version,
+            "blueprint": entry["blueprint"],
+            "feedback": entry["feedback"],
+            "timestamp": format_timestamp(entry["timestamp_ns"]),
+            "changes_made": entry["changes_made"],
+            "current_floor": current_floor
+        }
+        for version, entry in enumerate(history, 1)
+    ]
     
-    return {"history": design_storage[session_id]}
+    # History is built server-side, so skip the encoder pass and dump it directly
+    return Response(msgspec.json.encode({"history": history}), media_type="application/json")
 
 @app.get("/api/current-floor/{session_id}")
-async def get_current_floor(session_id: str):
+async def get_current_floor(session_id: str, request: Request):
     """Get current floor number"""
-    if session_id not in design_storage:
+    current_floor = await load_current_floor(request.app.state.redis, session_id)
+    if current_floor is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    history = design_storage[session_id]
-    current_floor = 1
-    if history:
-        current_floor = history[-1].get("current_floor", 1)
-    
     return {"current_floor": current_floor}
 
 if __name__ == "__main__":
@@ -2,10 +2,51 @@
 LLM Prompt System for Blueprint Generation
 Designed for Groq Cloud GPT models
 """
+from typing import Any, Dict, Sequence
+
+# Extra layout rules appended to the initial prompt, by building type
+BUILDING_SPECIFIC_REQUIREMENTS: Dict[str, str] = {
+    'hospital': """
+- Patient rooms: min 12 sq.m single, 18 sq.m double
+- Corridors: min 2.4m wide for bed access
+- Nurse stations: central visibility
+- Emergency exits: multiple egress paths
+- Specialized rooms: OR, ICU, pharmacy, lab
+- Utility rooms: medical gas, electrical, housekeeping
+- Infection control: proper ventilation zones
+""",
+    'residential': """
+- Bedrooms: privacy and natural light
+- Kitchen: work triangle efficiency
+- Living areas: social interaction spaces
+- Storage: minimum 10% of floor area
+- Bathrooms: proper ventilation
+- Entry: transition space from exterior
+- Circulation: minimize corridor space
+""",
+    'office': """
+- Open office: 6-10 sq.m per workstation
+- Meeting rooms: various sizes for teams
+- Break rooms: social and food prep areas
+- Reception: welcoming entrance
+- Storage: filing and supplies
+- Server room: climate controlled
+- Accessibility: ADA compliant throughout
+""",
+    'educational': """
+- Classrooms: 2 sq.m per student minimum
+- Wide corridors: 3m+ for student flow
+- Emergency exits: maximum 45m travel distance
+- Specialized rooms: labs, library, gym
+- Administrative offices: principal, counselors
+- Accessibility: full ADA compliance
+- Safety: secure entrances, sight lines
+"""
+}
 
 class BlueprintPromptGenerator:
-    def __init__(self):
-        self.system_prompt = """
+    def __init__(self) -> None:
+        self.system_prompt: str = """
 You are an expert architect and building designer specializing in creating detailed floor plans. 
 Your role is to generate precise, code-compliant building layouts in JSON format.
 
@@ -27,7 +68,7 @@ DIMENSIONAL STANDARDS:
 Always respond in valid JSON format matching the provided schema.
 """
 
-    def generate_initial_prompt(self, building_type, requirements):
+    def generate_initial_prompt(self, building_type: str, requirements: Dict[str, Any]) -> str:
         """Generate initial blueprint creation prompt"""
         return f"""
 {self.system_prompt}
@@ -48,7 +89,7 @@ SPECIFIC NEEDS FOR {building_type.upper()}:
 Generate a complete JSON blueprint following the schema. Ensure all dimensions are realistic and code-compliant.
 """
 
-    def generate_iteration_prompt(self, current_design, user_feedback):
+    def generate_iteration_prompt(self, current_design: str, user_feedback: str) -> str:
         """Generate prompt for design iterations"""
         return f"""
 {self.system_prompt}
@@ -71,49 +112,11 @@ INSTRUCTIONS:
 Return the complete updated JSON blueprint.
 """
 
-    def _get_building_specific_requirements(self, building_type):
+    def _get_building_specific_requirements(self, building_type: str) -> str:
         """Get specific requirements based on building type"""
-        requirements = {
-            'hospital': """
-- Patient rooms: min 12 sq.m single, 18 sq.m double
-- Corridors: min 2.4m wide for bed access
-- Nurse stations: central visibility
-- Emergency exits: multiple egress paths
-- Specialized rooms: OR, ICU, pharmacy, lab
-- Utility rooms: medical gas, electrical, housekeeping
-- Infection control: proper ventilation zones
-""",
-            'residential': """
-- Bedrooms: privacy and natural light
-- Kitchen: work triangle efficiency
-- Living areas: social interaction spaces
-- Storage: minimum 10% of floor area
-- Bathrooms: proper ventilation
-- Entry: transition space from exterior
-- Circulation: minimize corridor space
-""",
-            'office': """
-- Open office: 6-10 sq.m per workstation
-- Meeting rooms: various sizes for teams
-- Break rooms: social and food prep areas
-- Reception: welcoming entrance
-- Storage: filing and supplies
-- Server room: climate controlled
-- Accessibility: ADA compliant throughout
-""",
-            'educational': """
-- Classrooms: 2 sq.m per student minimum
-- Wide corridors: 3m+ for student flow
-- Emergency exits: maximum 45m travel distance
-- Specialized rooms: labs, library, gym
-- Administrative offices: principal, counselors
-- Accessibility: full ADA compliance
-- Safety: secure entrances, sight lines
-"""
-        }
-        return requirements.get(building_type, "Standard commercial requirements apply.")
+        return BUILDING_SPECIFIC_REQUIREMENTS.get(building_type, "Standard commercial requirements apply.")
 
-    def generate_optimization_prompt(self, design, optimization_goals):
+    def generate_optimization_prompt(self, design: str, optimization_goals: Sequence[str]) -> str:
         """Generate prompt for design optimization"""
         return f"""
 {self.system_prompt}
@@ -138,19 +141,20 @@ Analyze each room and circulation area. Propose improvements while maintaining t
 Return the optimized JSON blueprint.
 """
 
-# Example usage
-prompt_generator = BlueprintPromptGenerator()
-
-# Example requirements
-requirements = {
-    'total_area': 200,
-    'floors': 1,
-    'special_features': ['wheelchair_accessible', 'family_friendly'],
-    'occupancy': '4 people',
-    'budget_level': 'moderate'
-}
-
-# Generate initial prompt
-initial_prompt = prompt_generator.generate_initial_prompt('residential', requirements)
-print("=== INITIAL PROMPT ===")
-print(initial_prompt)
\ No newline at end of file
+if __name__ == "__main__":
+    # Example usage
+    prompt_generator = BlueprintPromptGenerator()
+
+    # Example requirements
+    requirements = {
+        'total_area': 200,
+        'floors': 1,
+        'special_features': ['wheelchair_accessible', 'family_friendly'],
+        'occupancy': '4 people',
+        'budget_level': 'moderate'
+    }
+
+    # Generate initial prompt
+    initial_prompt = prompt_generator.generate_initial_prompt('residential', requirements)
+    print("=== INITIAL PROMPT ===")
+    print(initial_prompt)